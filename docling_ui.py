@@ -1,58 +1,208 @@
 import streamlit as st
 import os
-import tempfile
+import hashlib
+import logging
+import time
 from pathlib import Path
-import subprocess
-import platform
+from contextlib import contextmanager
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from docling.datamodel.base_models import DocumentStream, InputFormat
+from docling.datamodel.pipeline_options import PdfPipelineOptions
+from docling.document_converter import DocumentConverter, PdfFormatOption
+
+# 项目的tmp目录，路径在导入时确定一次，保存结果时按需创建
+_DEFAULT_OUTPUT_DIR = Path(__file__).parent / 'tmp'
 
 def get_default_output_dir():
     """返回项目的tmp目录"""
-    # 获取当前脚本所在目录
-    current_dir = Path(__file__).parent
-    # 创建tmp目录
-    tmp_dir = current_dir / 'tmp'
-    tmp_dir.mkdir(exist_ok=True)
-    return tmp_dir
-
-def run_docling_command(input_path, output_formats, use_ocr=True):
-    """执行docling命令行"""
-    input_path = Path(input_path)
-    cmd = ["docling", str(input_path)]
-    
-    # 从临时文件名中提取原始文件名
-    original_filename = input_path.name.split('_', 1)[1] if '_' in input_path.name else input_path.name
-    original_stem = Path(original_filename).stem
-    
-    # 存储所有输出文件路径
-    output_files = []
-    output_dir = get_default_output_dir()
-    
-    # 添加输出格式
-    for fmt in output_formats:
-        output_path = output_dir / f"{original_stem}.{fmt}"
-        cmd.extend(["--to", fmt])
-        cmd.extend(["--output", str(output_path)])
-        # 如果是目录，找到目录中的实际文件
-        if output_path.is_dir():
-            # 查找目录中的对应格式文件
-            files = list(output_path.glob(f"*.{fmt}"))
-            if files:
-                output_files.extend(files)
-        else:
-            output_files.append(output_path)
+    return _DEFAULT_OUTPUT_DIR
+
+# 界面更新的批量刷新条件：每完成若干个文件或间隔一定秒数刷新一次
+_FLUSH_EVERY = 4
+_FLUSH_INTERVAL = 0.25
+
+# 整个进程内同时进行的转换数上限；docling的PDF流水线和torch本身会用多个核心，
+# 并发过多只会争抢CPU并成倍增加内存（每个PDF的页面图像）
+_MAX_CONCURRENT_CONVERSIONS = 2
+
+# 支持的输入文件类型
+_SUPPORTED_SUFFIXES = {".pdf", ".docx"}
+
+# 各输出格式对应的保存方法
+_SAVERS = {
+    "md": lambda document, path: document.save_as_markdown(path),
+    "json": lambda document, path: document.save_as_json(path),
+}
+
+@st.cache_resource(show_spinner="正在加载模型...")
+def get_converter(use_ocr=True):
+    """返回进程内共享的DocumentConverter，所有会话只加载一次模型
     
-    # OCR选项
-    if not use_ocr:
-        cmd.append("--no-ocr")
+    这里假设同一个转换器可以被多个线程同时调用convert()：流水线初始化后
+    只读共享，每次转换的页面数据各自独立。并发数由get_conversion_slots()限制。
+    """
+    pipeline_options = PdfPipelineOptions(do_ocr=use_ocr)
+    converter = DocumentConverter(
+        format_options={InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options)}
+    )
+    # 构造时只保存配置，PDF流水线和模型在首次转换时才加载，这里提前加载
+    converter.initialize_pipeline(InputFormat.PDF)
+    return converter
+
+@st.cache_resource
+def get_conversion_slots():
+    """返回进程内共享的信号量，限制所有会话同时进行的转换数"""
+    return threading.BoundedSemaphore(_MAX_CONCURRENT_CONVERSIONS)
+
+def run_docling_command(source, output_formats, use_ocr=True, output_dir=None, output_stem=None):
+    """执行docling转换，source可以是文件路径或DocumentStream"""
+    input_name = Path(getattr(source, 'name', source))
+    output_dir = Path(output_dir) if output_dir else get_default_output_dir()
+    # 默认以输入文件名命名输出文件
+    output_stem = output_stem or input_name.stem
     
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode == 0:
-            return True, result.stdout, output_files
-        else:
-            return False, result.stderr, []
+        # 目录可能在运行期间被删除，保存前确保存在
+        output_dir.mkdir(parents=True, exist_ok=True)
+        
+        # 一次转换生成所有输出格式，避免重复解析和OCR
+        with get_conversion_slots():
+            result = get_converter(use_ocr).convert(source)
+        
+        # 输出文件路径一次性构造
+        output_files = [output_dir / f"{output_stem}.{fmt}" for fmt in output_formats]
+        for fmt, output_path in zip(output_formats, output_files):
+            _SAVERS[fmt](result.document, output_path)
     except Exception as e:
         return False, str(e), []
+    
+    return True, result.status.value, output_files
+
+class _StatusHandler(logging.Handler):
+    """收集当前会话中docling的最新一行日志，由主线程负责显示
+    
+    日志来自st.cache_data函数内部的工作线程，在这里调用st.*会被记录进缓存，
+    命中缓存时重放会失败，所以只保存文本。
+    """
+    
+    def __init__(self, ctx):
+        super().__init__(logging.INFO)
+        self.ctx = ctx
+        self.latest = None
+    
+    def emit(self, record):
+        # 只收集本会话线程产生的日志
+        if get_script_run_ctx(suppress_warning=True) is self.ctx:
+            with self.lock:
+                self.latest = self.format(record)
+    
+    def pop_latest(self):
+        """取出最新一行日志，没有新日志时返回None"""
+        with self.lock:
+            latest, self.latest = self.latest, None
+        return latest
+
+class _LogLevelGuard:
+    """在并发的转换批次之间共享docling日志级别的修改，按嵌套计数只在首尾设置和恢复"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.depth = 0
+        self.previous_level = logging.NOTSET
+    
+    def enter(self, logger):
+        with self.lock:
+            if self.depth == 0:
+                self.previous_level = logger.level
+                if logger.getEffectiveLevel() > logging.INFO:
+                    logger.setLevel(logging.INFO)
+            self.depth += 1
+    
+    def exit(self, logger):
+        with self.lock:
+            self.depth -= 1
+            if self.depth == 0:
+                logger.setLevel(self.previous_level)
+
+@st.cache_resource
+def _get_log_level_guard():
+    """返回进程内唯一的日志级别管理器（脚本重跑时模块级对象会被重新创建）"""
+    return _LogLevelGuard()
+
+@contextmanager
+def _stream_docling_logs(ctx):
+    """转换期间收集docling日志，返回的handler供主线程读取最新一行"""
+    docling_logger = logging.getLogger("docling")
+    guard = _get_log_level_guard()
+    handler = _StatusHandler(ctx)
+    docling_logger.addHandler(handler)
+    guard.enter(docling_logger)
+    try:
+        yield handler
+    finally:
+        docling_logger.removeHandler(handler)
+        guard.exit(docling_logger)
+
+def _flush_messages(successes, errors):
+    """把缓存的转换结果合并成一条消息显示，然后清空缓存"""
+    if successes:
+        st.success("\n".join(f"- {line}" for line in successes))
+        successes.clear()
+    if errors:
+        st.error("\n".join(f"- {line}" for line in errors))
+        errors.clear()
+
+class ConversionError(Exception):
+    """转换失败（异常不会被st.cache_data缓存）"""
+
+def _convert_upload(file_digest, original_filename, output_formats, use_ocr, output_dir, _uploaded_file):
+    """转换单个上传文件，返回 (消息, 输出文件列表)；输出路径完全由参数决定"""
+    # 上传文件本身就是BytesIO，直接作为输入流交给docling，无需写临时文件
+    _uploaded_file.seek(0)
+    source = DocumentStream(name=original_filename, stream=_uploaded_file)
+    # 输出文件名带上内容哈希和OCR选项，避免同名文件或不同OCR设置的结果互相覆盖
+    output_stem = f"{Path(original_filename).stem}_{file_digest[:8]}_{'ocr' if use_ocr else 'noocr'}"
+    
+    # 执行转换
+    success, message, output_files = run_docling_command(
+        source,
+        list(output_formats),
+        use_ocr,
+        output_dir,
+        output_stem
+    )
+    
+    if not success:
+        raise ConversionError(message)
+    return message, output_files
+
+# 按文件内容哈希缓存转换结果
+_cached_convert = st.cache_data(show_spinner=False, persist="disk")(_convert_upload)
+
+def _process_one(uploaded_file, output_formats, use_ocr, output_dir):
+    """处理单个上传文件，返回 (文件名, 是否成功, 消息, 输出文件列表)"""
+    original_filename = uploaded_file.name
+    # 在计算哈希和查询缓存之前先检查文件类型
+    suffix = Path(original_filename).suffix
+    if suffix.lower() not in _SUPPORTED_SUFFIXES:
+        return original_filename, False, f"不支持的文件类型: {suffix}", []
+    
+    file_digest = hashlib.sha256(uploaded_file.getbuffer()).hexdigest()
+    args = (file_digest, original_filename, tuple(output_formats), use_ocr, str(output_dir), uploaded_file)
+    
+    try:
+        message, output_files = _cached_convert(*args)
+        # 缓存的输出文件可能已被删除，此时绕过缓存重新转换；
+        # 结果会写回相同的路径，该缓存条目随之重新有效，其他条目不受影响
+        if not all(path.exists() for path in output_files):
+            message, output_files = _convert_upload(*args)
+    except Exception as e:
+        # 任何异常都只算作这个文件转换失败，不影响同批次的其他文件
+        return original_filename, False, str(e), []
+    
+    return original_filename, True, message, output_files
 
 def main():
     st.title("Docling 文档转换工具")
@@ -84,45 +234,79 @@ def main():
             st.error("请至少选择一种输出格式")
             return
         
+        # 输出格式对整批文件都一样，只检查一次
+        unsupported_formats = set(output_formats) - _SAVERS.keys()
+        if unsupported_formats:
+            st.error(f"不支持的输出格式: {', '.join(sorted(unsupported_formats))}")
+            return
+        
+        # 跳过空文件
+        empty_files = [f.name for f in uploaded_files if f.size == 0]
+        if empty_files:
+            st.warning(f"已跳过空文件: {', '.join(empty_files)}")
+            uploaded_files = [f for f in uploaded_files if f.size > 0]
+            if not uploaded_files:
+                return
+        
         # 创建进度条
         progress_bar = st.progress(0)
         status_text = st.empty()
         
         # 存储所有生成的文件信息
         generated_files = []
+        output_dir = get_default_output_dir()
+        # 在主线程中加载模型，避免多个工作线程同时首次加载
+        get_converter(use_ocr)
         
-        # 处理每个上传的文件
-        for i, uploaded_file in enumerate(uploaded_files):
-            progress = (i + 1) / len(uploaded_files)
-            status_text.text(f"正在处理: {uploaded_file.name}")
+        # 转换时模型推理会释放GIL，多个文件可以用线程池并行处理
+        status_text.text(f"正在处理 {len(uploaded_files)} 个文件")
+        ctx = get_script_run_ctx()
+        max_workers = min(len(uploaded_files), os.cpu_count() or 1)
+        with _stream_docling_logs(ctx) as log_handler, ThreadPoolExecutor(
+            max_workers=max_workers,
+            # 工作线程需要绑定Streamlit的运行上下文
+            initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)
+        ) as executor:
+            futures = [
+                executor.submit(_process_one, uploaded_file, output_formats, use_ocr, output_dir)
+                for uploaded_file in uploaded_files
+            ]
             
-            # 创建临时文件，保持原始文件名
-            original_filename = uploaded_file.name
-            with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{original_filename}") as tmp_file:
-                tmp_file.write(uploaded_file.getvalue())
-                tmp_path = tmp_file.name
-            
-            # 执行转换
-            success, message, output_files = run_docling_command(
-                tmp_path,
-                output_formats,
-                use_ocr
-            )
-            
-            # 删除临时文件
-            os.unlink(tmp_path)
-            
-            # 更新进度
-            progress_bar.progress(progress)
+            # 结果先缓存起来，批量刷新到界面，减少websocket消息；
+            # 即使没有新文件完成，也按时间间隔把缓存的结果刷新出去
+            successes, errors = [], []
+            pending = set(futures)
+            done = unflushed = 0
+            last_flush = time.monotonic()
+            while pending:
+                finished, pending = wait(pending, timeout=_FLUSH_INTERVAL, return_when=FIRST_COMPLETED)
+                # 显示工作线程收集到的最新日志
+                log_line = log_handler.pop_latest()
+                if log_line is not None:
+                    status_text.text(log_line)
+                for future in finished:
+                    original_filename, success, message, output_files = future.result()
+                    done += 1
+                    unflushed += 1
+                    
+                    # 记录结果
+                    if success:
+                        for output_file in output_files:
+                            successes.append(f"{original_filename} 转换成功，已生成文件：{output_file}")
+                            # 将成功生成的文件添加到列表；磁盘上的文件名带哈希，下载时用原始文件名
+                            download_name = f"{Path(original_filename).stem}{output_file.suffix}"
+                            generated_files.append((output_file, download_name))
+                    else:
+                        errors.append(f"{original_filename} 转换失败: {message}")
+                
+                # 更新进度并显示结果
+                if unflushed and (unflushed >= _FLUSH_EVERY or time.monotonic() - last_flush >= _FLUSH_INTERVAL):
+                    progress_bar.progress(done / len(uploaded_files))
+                    _flush_messages(successes, errors)
+                    unflushed = 0
+                    last_flush = time.monotonic()
             
-            # 显示结果
-            if success:
-                for output_file in output_files:
-                    st.success(f"{original_filename} 转换成功，已生成文件：{output_file}")
-                    # 将成功生成的文件添加到列表
-                    generated_files.append(output_file)
-            else:
-                st.error(f"{original_filename} 转换失败: {message}")
+            _flush_messages(successes, errors)
         
         # 完成处理
         status_text.text("所有文件处理完成")
@@ -131,34 +315,20 @@ def main():
         # 显示下载区域
         if generated_files:
             st.markdown("### 下载转换后的文件")
-            for file_path in generated_files:
-                try:
-                    # 检查是否为目录
-                    if file_path.is_dir():
-                        # 如果是目录，找到目录中的所有文件
-                        for actual_file in file_path.glob("*.*"):
-                            with open(actual_file, 'rb') as f:
-                                file_content = f.read()
-                                file_name = actual_file.name
-                                st.download_button(
-                                    label=f"下载 {file_name}",
-                                    data=file_content,
-                                    file_name=file_name,
-                                    mime='application/octet-stream'
-                                )
-                    else:
-                        # 如果是文件，直接读取
-                        with open(file_path, 'rb') as f:
-                            file_content = f.read()
-                            file_name = file_path.name
-                            st.download_button(
-                                label=f"下载 {file_name}",
-                                data=file_content,
-                                file_name=file_name,
-                                mime='application/octet-stream'
-                            )
-                except Exception as e:
-                    st.error(f"无法读取文件 {file_path}: {str(e)}")
+            for file_path, download_name in generated_files:
+                if not file_path.is_file():
+                    st.error(f"无法读取文件 {file_path}")
+                    continue
+                # 传入可调用对象，Streamlit在用户点击时才读取文件，页面渲染时不占内存；
+                # on_click="ignore" 避免点击下载触发重跑而清空结果列表
+                st.download_button(
+                    label=f"下载 {download_name}",
+                    data=file_path.read_bytes,
+                    file_name=download_name,
+                    mime='application/octet-stream',
+                    on_click="ignore",
+                    key=f"download_{file_path}"
+                )
 
 if __name__ == "__main__":
     import sys